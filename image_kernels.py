@@ -0,0 +1,214 @@
+import functools
+
+import numpy as np
+from numba import njit, prange, types, void, uint8
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+# CARLA's raw_data is a read-only buffer, so the arrays wrapping it are read-only too
+BGRA_FRAME = types.Array(types.uint8, 3, 'C', readonly=True)
+
+
+@functools.lru_cache(maxsize=None)
+def make_bgra_to_rgb_resize_kernel(height, width, target_height, target_width):
+    """Build a kernel that area-resizes a (H, W) BGRA image into a (W, H) RGB array, e.g. a pixels3d view
+
+    A pixels3d view is indexed (x, y) but laid out row-major like the surface, so the kernels loop over
+    rows outside and x inside: both the BGRA reads and the pixel writes are then sequential in memory.
+
+    The shapes are closed over so they are compile-time constants, and the explicit signature compiles
+    the kernel here rather than on the first frame. Closures are not cached to disk by Numba.
+    """
+    if height % target_height == 0 and width % target_width == 0:
+        return _make_box_downsample_kernel(height // target_height, width // target_width, target_height, target_width)
+
+    @njit(void(BGRA_FRAME, uint8[:, :, :]), parallel=True, fastmath=True)
+    def bgra_to_rgb_resize(src, dst):
+        for y in prange(target_height):
+            y0 = y * height // target_height
+            y1 = max((y + 1) * height // target_height, y0 + 1)
+            for x in range(target_width):
+                x0 = x * width // target_width
+                x1 = max((x + 1) * width // target_width, x0 + 1)
+                b = 0
+                g = 0
+                r = 0
+                for sy in range(y0, y1):
+                    for sx in range(x0, x1):
+                        b += src[sy, sx, 0]
+                        g += src[sy, sx, 1]
+                        r += src[sy, sx, 2]
+                count = (y1 - y0) * (x1 - x0)
+                dst[x, y, 0] = r // count
+                dst[x, y, 1] = g // count
+                dst[x, y, 2] = b // count
+
+    return bgra_to_rgb_resize
+
+
+def _make_box_downsample_kernel(ky, kx, target_height, target_width):
+    """Integer-ratio variant of make_bgra_to_rgb_resize_kernel: fixed ky x kx blocks, no per-pixel window math"""
+    count = ky * kx
+
+    @njit(void(BGRA_FRAME, uint8[:, :, :]), parallel=True, fastmath=True)
+    def box_downsample(src, dst):
+        for y in prange(target_height):
+            y0 = y * ky
+            for x in range(target_width):
+                x0 = x * kx
+                b = 0
+                g = 0
+                r = 0
+                for sy in range(y0, y0 + ky):
+                    for sx in range(x0, x0 + kx):
+                        b += src[sy, sx, 0]
+                        g += src[sy, sx, 1]
+                        r += src[sy, sx, 2]
+                # count is a constant, so power-of-two blocks divide with a shift
+                dst[x, y, 0] = r // count
+                dst[x, y, 1] = g // count
+                dst[x, y, 2] = b // count
+
+    return box_downsample
+
+
+def _make_depth_kernel(height, width, target_height, target_width, logarithmic):
+    """Build a kernel that decodes a (H, W) BGRA depth image into a (W, H) grayscale RGB array
+
+    Matches CARLA's Depth and LogarithmicDepth color converters. The nearest source pixel is sampled,
+    averaging the encoded bytes would corrupt the depth.
+    """
+    @njit(void(BGRA_FRAME, uint8[:, :, :]), parallel=True, fastmath=True)
+    def depth_to_gray(src, dst):
+        for y in prange(target_height):
+            sy = y * height // target_height
+            for x in range(target_width):
+                sx = x * width // target_width
+                depth = (np.float32(src[sy, sx, 2]) + np.float32(src[sy, sx, 1]) * 256.0
+                         + np.float32(src[sy, sx, 0]) * 65536.0) * (1.0 / 16777215.0)
+                if logarithmic:
+                    depth = min(max(1.0 + np.log(depth) / 5.70378, 0.005), 1.0)
+                value = np.uint8(255.0 * depth)
+                dst[x, y, 0] = value
+                dst[x, y, 1] = value
+                dst[x, y, 2] = value
+
+    return depth_to_gray
+
+
+@functools.lru_cache(maxsize=None)
+def make_depth_kernel(height, width, target_height, target_width):
+    return _make_depth_kernel(height, width, target_height, target_width, False)
+
+
+@functools.lru_cache(maxsize=None)
+def make_log_depth_kernel(height, width, target_height, target_width):
+    return _make_depth_kernel(height, width, target_height, target_width, True)
+
+
+# CARLA (0.9.14+) CityScapes palette, indexed by the semantic tag stored in the red channel
+CITYSCAPES_PALETTE = np.zeros((256, 3), dtype=np.uint8)
+CITYSCAPES_PALETTE[:29] = [
+    (0, 0, 0), (128, 64, 128), (244, 35, 232), (70, 70, 70), (102, 102, 156), (190, 153, 153),
+    (153, 153, 153), (250, 170, 30), (220, 220, 0), (107, 142, 35), (152, 251, 152), (70, 130, 180),
+    (220, 20, 60), (255, 0, 0), (0, 0, 142), (0, 0, 70), (0, 60, 100), (0, 80, 100), (0, 0, 230),
+    (119, 11, 32), (110, 190, 160), (170, 120, 50), (55, 90, 80), (45, 60, 150), (157, 234, 50),
+    (81, 0, 81), (150, 100, 100), (230, 150, 140), (180, 165, 180)]
+
+
+@functools.lru_cache(maxsize=None)
+def make_palette_kernel(height, width, target_height, target_width):
+    """Build a kernel that colors a (H, W) BGRA semantic segmentation image into a (W, H) RGB array
+
+    Tags are categorical, so the nearest source pixel is sampled instead of averaged.
+    """
+    @njit(void(BGRA_FRAME, uint8[:, :, :]), parallel=True, fastmath=True)
+    def palette_lookup(src, dst):
+        for y in prange(target_height):
+            sy = y * height // target_height
+            for x in range(target_width):
+                tag = src[sy, x * width // target_width, 2]
+                dst[x, y, 0] = CITYSCAPES_PALETTE[tag, 0]
+                dst[x, y, 1] = CITYSCAPES_PALETTE[tag, 1]
+                dst[x, y, 2] = CITYSCAPES_PALETTE[tag, 2]
+
+    return palette_lookup
+
+
+# kernel factories by image kind, each called with (height, width, target_height, target_width)
+DECODERS = {
+    'Raw': make_bgra_to_rgb_resize_kernel,
+    'Depth': make_depth_kernel,
+    'LogDepth': make_log_depth_kernel,
+    'SemanticSegmentation': make_palette_kernel,
+}
+
+
+_CUDA_BGRA_TO_RGB_RESIZE_SOURCE = r'''
+extern "C" __global__
+void bgra_to_rgb_resize(const unsigned char* src, unsigned char* dst,
+                        int height, int width, int target_height, int target_width)
+{
+    int x = blockDim.x * blockIdx.x + threadIdx.x;
+    int y = blockDim.y * blockIdx.y + threadIdx.y;
+    if (x >= target_width || y >= target_height)
+        return;
+
+    int y0 = y * height / target_height;
+    int y1 = max((y + 1) * height / target_height, y0 + 1);
+    int x0 = x * width / target_width;
+    int x1 = max((x + 1) * width / target_width, x0 + 1);
+
+    unsigned int b = 0, g = 0, r = 0;
+    for (int sy = y0; sy < y1; ++sy) {
+        for (int sx = x0; sx < x1; ++sx) {
+            const unsigned char* p = src + (sy * width + sx) * 4;
+            b += p[0];
+            g += p[1];
+            r += p[2];
+        }
+    }
+
+    unsigned int count = (y1 - y0) * (x1 - x0);
+    unsigned char* q = dst + (y * target_width + x) * 3;
+    q[0] = r / count;
+    q[1] = g / count;
+    q[2] = b / count;
+}
+'''
+
+
+class CudaBgraToRgbResize:
+    """GPU counterpart of make_bgra_to_rgb_resize_kernel, called the same way with host arrays
+
+    Only the downscaled RGB image is read back, the full-resolution frame never leaves the device. It is
+    produced row-major, the memory order of a pixels3d view, so the final copy into the surface is linear.
+    """
+    BLOCK = (16, 16)
+
+    def __init__(self, height, width, target_height, target_width):
+        if cupy is None:
+            raise RuntimeError('cannot import cupy, make sure cupy package is installed to use the cuda backend')
+
+        self.height = height
+        self.width = width
+        self.target_height = target_height
+        self.target_width = target_width
+        self._kernel = cupy.RawKernel(_CUDA_BGRA_TO_RGB_RESIZE_SOURCE, 'bgra_to_rgb_resize')
+        self._grid = ((target_width + self.BLOCK[0] - 1) // self.BLOCK[0],
+                      (target_height + self.BLOCK[1] - 1) // self.BLOCK[1])
+        self._args = (np.int32(height), np.int32(width), np.int32(target_height), np.int32(target_width))
+
+        # device and host staging buffers are reused by every frame
+        self._src_gpu = cupy.empty((height, width, 4), dtype=cupy.uint8)
+        self._dst_gpu = cupy.empty((target_height, target_width, 3), dtype=cupy.uint8)
+        self._dst_host = np.empty((target_height, target_width, 3), dtype=np.uint8)
+
+    def __call__(self, src, dst):
+        self._src_gpu.set(src)
+        self._kernel(self._grid, self.BLOCK, (self._src_gpu, self._dst_gpu) + self._args)
+        self._dst_gpu.get(out=self._dst_host)
+        dst[...] = self._dst_host.transpose(1, 0, 2)
@@ -3,10 +3,20 @@ import argparse
 import logging
 import numpy as np
 import time
-from PIL import Image 
+import collections
 
 from carla import ColorConverter as cc
 
+from image_kernels import DECODERS, CudaBgraToRgbResize
+
+# image kind decoded on the client for each CARLA color converter
+CONVERTER_KINDS = {
+    cc.Raw: 'Raw',
+    cc.Depth: 'Depth',
+    cc.LogarithmicDepth: 'LogDepth',
+    cc.CityScapesPalette: 'SemanticSegmentation',
+}
+
 try:
     import pygame
     from pygame.locals import K_ESCAPE
@@ -14,35 +24,25 @@ try:
 except ImportError:
     raise RuntimeError('cannot import pygame, make sure pygame package is installed')
 
-class CustomTimer:
-    def __init__(self):
-        try:
-            self.timer = time.perf_counter
-        except AttributeError:
-            self.timer = time.time
-
-    def time(self):
-        return self.timer()
-
 class DisplayManager:
     def __init__(self, grid_size, window_size):
-        pygame.init()
-        pygame.font.init()
+        # only the video subsystem is needed, the monitor renders no text so font is not initialized
+        pygame.display.init()
         self.display = pygame.display.set_mode(window_size, pygame.HWSURFACE | pygame.DOUBLEBUF)
 
         self.grid_size = grid_size
         self.window_size = window_size
+        self.display_size = (int(window_size[0] // grid_size[1]), int(window_size[1] // grid_size[0]))
         self.sensor_list = []
 
     def get_window_size(self):
         return [int(self.window_size[0]), int(self.window_size[1])]
 
     def get_display_size(self):
-        return [int(self.window_size[0]/self.grid_size[1]), int(self.window_size[1]/self.grid_size[0])]
+        return self.display_size
 
     def get_display_offset(self, gridPos):
-        dis_size = self.get_display_size()
-        return [int(gridPos[1] * dis_size[0]), int(gridPos[0] * dis_size[1])]
+        return (int(gridPos[1] * self.display_size[0]), int(gridPos[0] * self.display_size[1]))
 
     def add_sensor(self, sensor):
         self.sensor_list.append(sensor)
@@ -54,8 +54,9 @@ class DisplayManager:
         if not self.render_enabled():
             return
 
-        for s in self.sensor_list:
-            s.render()
+        # one batched blit for all sensor cells
+        blit_pairs = [pair for pair in (s.render() for s in self.sensor_list) if pair is not None]
+        self.display.blits(blit_pairs, doreturn=0)
 
         pygame.display.flip()
 
@@ -67,112 +68,236 @@ class DisplayManager:
         return self.display != None
     
 class SensorMonitorManager:
-    def __init__(self, vehicle_monitor, display_man, sensor_role_name, display_pos, color_converter=None):
+    PROFILE_EVERY = 64  # must be a power of two
+
+    def __init__(self, vehicle_monitor, display_man, sensor_role_name, display_pos, color_converter=None, stretch=False, profile=False, backend='cpu'):
         self.surface = None
         self.vehicle_monitor = vehicle_monitor
         self.display_man = display_man
         self.display_pos = display_pos
+        self.backend = backend
 
-        self.color_converter = color_converter
+        # images are always decoded on the client from the raw BGRA data, CARLA never converts them
+        self.color_converter = cc.Raw if color_converter is None else color_converter
+        if self.color_converter not in CONVERTER_KINDS:
+            raise ValueError("Unsupported color converter {}".format(self.color_converter))
 
-        self._sensor = None
         # get the sensor with the specified role name
-        for sensor in vehicle_monitor.sensors:
-            if sensor_role_name in sensor.attributes['role_name']:
-                self._sensor = sensor
-                break
+        self._sensor = vehicle_monitor.get_sensor(sensor_role_name)
+        if self._sensor is None:
+            raise ValueError("No sensor found with role name {}".format(sensor_role_name))
 
-        self.init_sensor_monitor()
-        self.timer = CustomTimer()
-        
-        self.time_processing = 0.0
-        self.tics_processing = 0.0
+        # sensor and display resolutions are fixed, so the resize target and offset are computed once
+        self.target_size = self.get_target_size(stretch)
+        self._offset = self.display_man.get_display_offset(self.display_pos)
 
+        # processing time is only measured when profiling, on one frame out of PROFILE_EVERY
+        self._profile = profile
+        self.time_processing = 0  # ns, summed over the sampled frames
+        self.tics_processing = 0
+        self.samples_processing = 0
+
+        self.init_sensor_monitor()
         self.display_man.add_sensor(self)
     
     def init_sensor_monitor(self):
-        if 'RGBCamera' or 'DepthCamera' in self._sensor.attributes['role_name']:
+        # CARLA calls the listener from its own thread: frames are drawn into a surface taken from _free
+        # and handed to the render thread through _latest, stale frames go back to _free.
+        # The renderer returns a surface to _free only once it stops displaying it, so with three surfaces
+        # one can be drawn, one pending and one displayed without the producer touching the displayed one.
+        # All surfaces use the display's pixel format so blits are plain copies without a format conversion
+        self._free = collections.deque(
+            pygame.Surface(self.target_size).convert(self.display_man.display) for _ in range(3))
+        self._latest = collections.deque()
+
+        role_name = self._sensor.attributes['role_name']
+        if 'Camera' in role_name:
+            kind = CONVERTER_KINDS[self.color_converter]
+            # the cuda backend pays off for high resolution raw sensors, where the resize is bandwidth bound
+            make_decoder = CudaBgraToRgbResize if self.backend == 'cuda' and kind == 'Raw' else DECODERS[kind]
+            self._decode = make_decoder(
+                int(self._sensor.attributes['image_size_y']), int(self._sensor.attributes['image_size_x']),
+                self.target_size[1], self.target_size[0])
             self._sensor.listen(self.process_camera_sensor)
+        elif 'Lidar' in role_name:
+            self._sensor.listen(self.process_lidar)
+        else:
+            logging.warning('no monitor handler for sensor %s', role_name)
     
     def get_sensor(self):
-        return self.sensor
-    
-
-    def process_camera_sensor(self, image):
-        t_start = self.timer.time()
+        return self._sensor
 
-        image.convert(self.color_converter)
-        array = np.frombuffer(image.raw_data, dtype=np.dtype("uint8"))
-        array = np.reshape(array, (image.height, image.width, 4))
-        array = array[:, :, :3]
-        array = array[:, :, ::-1]
-
-        # Resize the image to fit the display
-        array = self.fit_display(array)
-
-        if self.display_man.render_enabled():
-            self.surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
+    def start_profile(self):
+        if self._profile and (self.tics_processing & (self.PROFILE_EVERY - 1)) == 0:
+            return time.monotonic_ns()
+        return None
 
-        t_end = self.timer.time()
-        self.time_processing += (t_end-t_start)
+    def end_profile(self, t_start):
+        if not self._profile:
+            return
+        if t_start is not None:
+            self.time_processing += time.monotonic_ns() - t_start
+            self.samples_processing += 1
         self.tics_processing += 1
+    
 
-    def fit_display(self, image_array, stretch=False):
+    def process_camera_sensor(self, image):
+        t_start = self.start_profile()
+
+        array = self.bgra_view(image)
+
+        back = self.acquire_surface()
+        if back is not None:
+            # decode and resize straight into the surface pixels. The pixels3d view locks the surface: the producer
+            # only locks surfaces taken from _free, never the one the renderer holds, and drops the view before publishing
+            pixels = pygame.surfarray.pixels3d(back)
+            self.fit_display(array, pixels)
+            del pixels
+            self.publish_frame(back)
+
+        self.end_profile(t_start)
+
+    @staticmethod
+    def bgra_view(image):
+        # raw_data supports the buffer protocol, so this wraps CARLA's frame without copying it
+        return np.frombuffer(image.raw_data, dtype=np.uint8).reshape((image.height, image.width, 4))
+
+    def process_lidar(self, lidar_data):
+        t_start = self.start_profile()
+
+        # bird's-eye view of the point cloud, centered on the sensor
+        points = np.frombuffer(lidar_data.raw_data, dtype=np.dtype('f4'))
+        points = np.reshape(points, (int(points.shape[0] / 4), 4))
+        lidar_range = 2.0 * float(self._sensor.attributes['range'])
+        points = points[:, :2] * (min(self.target_size) / lidar_range)
+        points += (0.5 * self.target_size[0], 0.5 * self.target_size[1])
+        points = np.fabs(points).astype(np.int32)
+        inside = (points[:, 0] < self.target_size[0]) & (points[:, 1] < self.target_size[1])
+        points = points[inside]
+
+        back = self.acquire_surface()
+        if back is not None:
+            # same locking rule as process_camera_sensor
+            pixels = pygame.surfarray.pixels3d(back)
+            pixels.fill(0)
+            pixels[points[:, 0], points[:, 1]] = 255
+            del pixels
+            self.publish_frame(back)
+
+        self.end_profile(t_start)
+
+    def acquire_surface(self):
+        if not self.display_man.render_enabled():
+            return None
+        # empty only while the renderer is swapping surfaces, the frame is dropped then
+        try:
+            return self._free.popleft()
+        except IndexError:
+            return None
+
+    def publish_frame(self, surface):
+        # deque append/popleft are atomic under the GIL, only the newest pending frame is kept
+        self._latest.append(surface)
+        while len(self._latest) > 1:
+            try:
+                self._free.append(self._latest.popleft())
+            except IndexError:
+                break
 
-        
-        pil_image = Image.fromarray(image_array)
-        
-        if stretch:
-            target_size = self.display_man.get_display_size()  # Get the display size
-        else:
-            display_size = self.display_man.get_display_size()  # Get the display size
-            pil_image_size = pil_image.size  # Get the image size
-            ratio = min(display_size[0] / pil_image_size[0], display_size[1] / pil_image_size[1])
-            target_size = (int(pil_image_size[0] * ratio), int(pil_image_size[1] * ratio))
-            
+    def get_target_size(self, stretch=False):
+        display_size = self.display_man.get_display_size()  # Get the display size
+        # non-camera sensors have no image size and fill the whole cell
+        if stretch or 'image_size_x' not in self._sensor.attributes:
+            return tuple(display_size)
 
-        # Resize the image using Pillow
-        pil_image = pil_image.resize(target_size)
+        image_size = (int(self._sensor.attributes['image_size_x']), int(self._sensor.attributes['image_size_y']))
+        ratio = min(display_size[0] / image_size[0], display_size[1] / image_size[1])
+        return (int(image_size[0] * ratio), int(image_size[1] * ratio))
 
-        # Convert back to NumPy array for Pygame
-        return np.array(pil_image)
+    def fit_display(self, image_array, pixels):
+        # decoder specialized for this sensor's image kind and fixed resolution
+        self._decode(image_array, pixels)
     
     
     def render(self):
+        # keep the last surface when no new frame arrived, otherwise hand the displayed one back to the producer
+        try:
+            surface = self._latest.popleft()
+        except IndexError:
+            surface = None
+
+        if surface is not None:
+            if self.surface is not None:
+                self._free.append(self.surface)
+            self.surface = surface
+
         if self.surface is not None:
-            offset = self.display_man.get_display_offset(self.display_pos)
-            self.display_man.display.blit(self.surface, offset)
+            return (self.surface, self._offset)
+        return None
     
     def destroy(self):
         pass
 
+    def __repr__(self):
+        mean_ms = self.time_processing / self.samples_processing / 1e6 if self.samples_processing else 0.0
+        return '<SensorMonitorManager {} frames={} processing={:.3f} ms>'.format(
+            self._sensor.attributes['role_name'], self.tics_processing, mean_ms)
+
 
     
 class VehicleMonitor:
     def __init__(self, world, vehicle_role_name):
         self.world = world
         self.vehicle_role_name = vehicle_role_name
+        self.vehicle = None
         self.sensors = []
 
+        # Group the actors by role name in a single pass over the world
+        self._by_role = {}
+        for actor in self.world.get_actors():
+            role_name = actor.attributes.get('role_name')
+            self._by_role.setdefault(role_name, []).append(actor)
+
         # Get the vehicle with the specified role name
-        for vehicle in self.world.get_actors().filter('vehicle.*'):
-            if vehicle.attributes['role_name'] == vehicle_role_name:
-                self.vehicle = vehicle
+        for actor in self._by_role.get(vehicle_role_name, []):
+            if actor.type_id.startswith('vehicle.'):
+                self.vehicle = actor
                 break
         
         if self.vehicle is None:
             raise ValueError("No vehicle found with role name {}".format(vehicle_role_name))
         
         # Get all sensors attached to the vehicle
-        for sensor in self.world.get_actors().filter('sensor.*'):
-            if self.vehicle_role_name in sensor.attributes['role_name']:
-                self.sensors.append(sensor)
+        for role_name, actors in self._by_role.items():
+            if role_name is not None and self.vehicle_role_name in role_name:
+                self.sensors.extend(actor for actor in actors if actor.type_id.startswith('sensor.'))
+
+        self._sensor_by_role = {sensor.attributes['role_name']: sensor for sensor in self.sensors}
     
     def get_sensor(self, sensor_role_name):
+        # sensors are named "<vehicle role>/<sensor role>"
+        sensor = self._sensor_by_role.get('{}/{}'.format(self.vehicle_role_name, sensor_role_name))
+        if sensor is None:
+            sensor = self._sensor_by_role.get(sensor_role_name)
+        if sensor is not None:
+            return sensor
+
         for sensor in self.sensors:
             if sensor_role_name in sensor.attributes['role_name']:
                 return sensor
         return None
+
+    def check_sensor_resolution(self, display_size):
+        # a camera rendering at twice the display cell size or more wastes server, network and client time
+        for sensor in self.sensors:
+            if 'image_size_x' not in sensor.attributes:
+                continue
+            image_size = (int(sensor.attributes['image_size_x']), int(sensor.attributes['image_size_y']))
+            if image_size[0] >= 2 * display_size[0] and image_size[1] >= 2 * display_size[1]:
+                logging.warning("sensor %s renders %dx%d for a %dx%d display cell, consider spawning it with "
+                                "image_size_x=%d and image_size_y=%d", sensor.attributes['role_name'],
+                                image_size[0], image_size[1], display_size[0], display_size[1],
+                                display_size[0], display_size[1])
         
     
 
@@ -214,16 +339,20 @@ def argparser():
         metavar='NAME',
         default='hero',
         help='Name of the vehicle role to monitor (default: "hero")')
+    argparser.add_argument(
+        '--backend',
+        choices=['cpu', 'cuda'],
+        default='cpu',
+        help='Where camera frames are resized, cuda requires cupy (default: cpu)')
     
     return argparser.parse_args()
 
 
 
-def monitor_loop(args):
-    pygame.init()
-    pygame.font.init()
+EVENT_CHECK_PERIOD = 0.016  # seconds
 
 
+def monitor_loop(args):
     try:
         client = carla.Client('127.0.0.1', 2000)
         client.set_timeout(10.0)
@@ -238,11 +367,12 @@ def monitor_loop(args):
         # initialize 
         vehicle_monitor = VehicleMonitor(sim_world, args.rolename)
         display_manager = DisplayManager(grid_size=[2, 2], window_size=[args.width, args.height])
+        vehicle_monitor.check_sensor_resolution(display_manager.get_display_size())
 
         # add sensor monitor to the display manager
-        SensorMonitorManager(vehicle_monitor, display_manager, 'RGBCamera_Driver_Seat', display_pos=[0, 0], color_converter=cc.Raw)
-        SensorMonitorManager(vehicle_monitor, display_manager, 'DepthCamera_Bumper', display_pos=[0, 1], color_converter=cc.Raw)
-        SensorMonitorManager(vehicle_monitor, display_manager, 'DepthCamera_Rear', display_pos=[1, 0], color_converter=cc.Depth)
+        SensorMonitorManager(vehicle_monitor, display_manager, 'RGBCamera_Driver_Seat', display_pos=[0, 0], color_converter=cc.Raw, profile=args.debug, backend=args.backend)
+        SensorMonitorManager(vehicle_monitor, display_manager, 'DepthCamera_Bumper', display_pos=[0, 1], color_converter=cc.Raw, profile=args.debug, backend=args.backend)
+        SensorMonitorManager(vehicle_monitor, display_manager, 'DepthCamera_Rear', display_pos=[1, 0], color_converter=cc.Depth, profile=args.debug)
         # SensorMonitorManager(vehicle_monitor, display_manager, 'DepthCamera_Bumper', display_pos=[1, 1], color_converter=cc.LogarithmicDepth)
 
 
@@ -251,6 +381,11 @@ def monitor_loop(args):
 
         print(display_manager.get_display_size())
 
+        # only the events handled below are queued, and the queue is checked at most every EVENT_CHECK_PERIOD
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN])
+        next_event_check = 0.0
+
         while True:
             if args.sync:
                 sim_world.tick()
@@ -260,17 +395,24 @@ def monitor_loop(args):
             # Render received data
             display_manager.render()
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    call_exit = True
-                elif event.type == pygame.KEYDOWN:
-                    if event.key == K_ESCAPE or event.key == K_q:
-                        call_exit = True
-                        break
+            now = time.monotonic()
+            if now >= next_event_check:
+                next_event_check = now + EVENT_CHECK_PERIOD
+                if pygame.event.peek([pygame.QUIT, pygame.KEYDOWN]):
+                    for event in pygame.event.get():
+                        if event.type == pygame.QUIT:
+                            call_exit = True
+                        elif event.type == pygame.KEYDOWN:
+                            if event.key == K_ESCAPE or event.key == K_q:
+                                call_exit = True
+                                break
 
             if call_exit:
                 break
 
+        for s in display_manager.get_sensor_list():
+            logging.debug('%r', s)
+
         
 
     finally:
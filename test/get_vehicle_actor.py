@@ -16,8 +16,7 @@ def parse_image(image):
     render_queue.put(surface)
 
 if __name__ == '__main__':
-    pygame.init()
-    pygame.font.init()
+    pygame.display.init()
     test_actor_world  = None
 
     try:
@@ -0,0 +1,96 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from image_kernels import DECODERS, CITYSCAPES_PALETTE
+
+
+def bgra_frame(height, width, seed=0):
+    # read-only like the arrays wrapping CARLA's image.raw_data
+    data = np.random.default_rng(seed).integers(0, 256, size=(height, width, 4), dtype=np.uint8)
+    return np.frombuffer(data.tobytes(), dtype=np.uint8).reshape((height, width, 4))
+
+
+def area_resize_reference(src, target_height, target_width):
+    height, width = src.shape[:2]
+    dst = np.empty((target_height, target_width, 3), dtype=np.uint8)
+    for y in range(target_height):
+        y0 = y * height // target_height
+        y1 = max((y + 1) * height // target_height, y0 + 1)
+        for x in range(target_width):
+            x0 = x * width // target_width
+            x1 = max((x + 1) * width // target_width, x0 + 1)
+            block = src[y0:y1, x0:x1, 2::-1].reshape(-1, 3).astype(np.int64)
+            dst[y, x] = block.sum(axis=0) // block.shape[0]
+    return dst
+
+
+def nearest(src, target_height, target_width):
+    height, width = src.shape[:2]
+    ys = np.arange(target_height) * height // target_height
+    xs = np.arange(target_width) * width // target_width
+    return src[ys][:, xs]
+
+
+def depth_reference(src, target_height, target_width, logarithmic):
+    src = nearest(src, target_height, target_width).astype(np.float64)
+    depth = (src[:, :, 2] + src[:, :, 1] * 256.0 + src[:, :, 0] * 65536.0) / 16777215.0
+    if logarithmic:
+        with np.errstate(divide='ignore'):
+            depth = np.clip(1.0 + np.log(depth) / 5.70378, 0.005, 1.0)
+    gray = (255.0 * depth).astype(np.uint8)
+    return np.repeat(gray[:, :, None], 3, axis=2)
+
+
+def palette_reference(src, target_height, target_width):
+    return CITYSCAPES_PALETTE[nearest(src, target_height, target_width)[:, :, 2]]
+
+
+def run_decoder(kind, src, target_height, target_width):
+    decode = DECODERS[kind](src.shape[0], src.shape[1], target_height, target_width)
+    dst = np.empty((target_width, target_height, 3), dtype=np.uint8)
+    decode(src, dst)
+    return dst.transpose(1, 0, 2)
+
+
+# (height, width, target_height, target_width): integer ratio, fractional ratio and upscale
+SHAPES = [(8, 12, 4, 6), (9, 14, 4, 5), (3, 4, 6, 8)]
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_raw_matches_area_resize(shape):
+    height, width, target_height, target_width = shape
+    src = bgra_frame(height, width)
+    np.testing.assert_array_equal(run_decoder('Raw', src, target_height, target_width),
+                                  area_resize_reference(src, target_height, target_width))
+
+
+def test_raw_writes_into_pixels3d_like_view():
+    src = bgra_frame(8, 12)
+    decode = DECODERS['Raw'](8, 12, 4, 6)
+    # a pixels3d view of a 32-bit BGRA surface: indexed (x, y), row-major memory, reversed channels
+    surface = np.zeros((4, 6, 4), dtype=np.uint8)
+    decode(src, surface.transpose(1, 0, 2)[:, :, 2::-1])
+    np.testing.assert_array_equal(surface[:, :, 2::-1], area_resize_reference(src, 4, 6))
+
+
+@pytest.mark.parametrize('kind, logarithmic', [('Depth', False), ('LogDepth', True)])
+@pytest.mark.parametrize('shape', SHAPES)
+def test_depth_matches_reference(kind, logarithmic, shape):
+    height, width, target_height, target_width = shape
+    src = bgra_frame(height, width)
+    # decoded in float32 with fastmath, so allow one gray level of rounding difference
+    np.testing.assert_allclose(run_decoder(kind, src, target_height, target_width),
+                               depth_reference(src, target_height, target_width, logarithmic), atol=1)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_semantic_segmentation_matches_palette(shape):
+    height, width, target_height, target_width = shape
+    src = bgra_frame(height, width)
+    np.testing.assert_array_equal(run_decoder('SemanticSegmentation', src, target_height, target_width),
+                                  palette_reference(src, target_height, target_width))